@@ -5,6 +5,8 @@ import numpy as np
 import asyncio
 import json
 import base64
+import functools
+import socket
 from io import BytesIO
 from typing import Dict, Any, List, Tuple
 from datetime import datetime, timezone
@@ -25,6 +27,8 @@ from calibration import CalibrationAgent
 from detection import DetectionAgent
 from orbit import OrbitAgent
 
+from utils.state_backend import create_state_backend
+
 # --- Configuration ---
 # Configure logging for the entire pipeline
 logging.basicConfig(
@@ -52,8 +56,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Store the latest pipeline results in memory for the polling endpoint
-latest_pipeline_results: Dict[str, Any] = {
+# --- Shared State ---
+# 'memory' keeps state in this process (single worker only). Use 'sqlite' when
+# running uvicorn with --workers N so all workers share one frame queue and
+# one set of latest results.
+STATE_BACKEND = os.environ.get("PIPELINE_STATE_BACKEND", "memory")
+STATE_DB_PATH = os.environ.get("PIPELINE_STATE_DB", "pipeline_state.db")
+FRAME_INTERVAL_SECONDS = float(os.environ.get("PIPELINE_FRAME_INTERVAL", "5"))
+FRAME_LEASE_SECONDS = 60.0 # Must exceed the time one frame takes to process
+FRAME_POLL_SECONDS = 0.5
+MAX_PENDING_FRAMES = 20 # Producer backpressure when workers fall behind
+WORKER_ID = f"{socket.gethostname()}-{os.getpid()}"
+
+state_backend = create_state_backend(STATE_BACKEND, STATE_DB_PATH)
+
+# Served by the polling endpoint until the first frame has been processed
+IDLE_PIPELINE_RESULTS: Dict[str, Any] = {
     "status": "Idle",
     "filename": "N/A",
     "detections": [],
@@ -127,13 +145,9 @@ async def run_asteroid_detection_pipeline_async(fits_file_path: str) -> Dict[str
     """
     Asynchronously orchestrates the multi-agent asteroid detection pipeline.
     """
-    global latest_pipeline_results 
-
     logger.info(f"Starting asteroid detection pipeline for {fits_file_path}")
     
     pipeline_run_results: Dict[str, Any] = {"status": "processing", "filename": os.path.basename(fits_file_path)}
-    
-    file_to_delete = fits_file_path
 
     try:
         logger.info("Step 1: Running Ingest Agent...")
@@ -168,60 +182,97 @@ async def run_asteroid_detection_pipeline_async(fits_file_path: str) -> Dict[str
 
         pipeline_run_results["status"] = "success"
         logger.info("Asteroid detection pipeline completed successfully.")
-        
-        # Update the global latest results
-        latest_pipeline_results = pipeline_run_results
         return pipeline_run_results
 
     except FileNotFoundError:
         logger.error(f"Error: FITS file not found at {fits_file_path}. Please check the path.")
         pipeline_run_results["status"] = "failed"
         pipeline_run_results["error"] = "File not found"
-        latest_pipeline_results = pipeline_run_results
         return pipeline_run_results
     except Exception as e:
         logger.critical(f"An unhandled error occurred during pipeline execution: {e}", exc_info=True)
         pipeline_run_results["status"] = "failed"
         pipeline_run_results["error"] = str(e)
-        latest_pipeline_results = pipeline_run_results
         return pipeline_run_results
-    finally:
-        await asyncio.sleep(0.1)
-        try:
-            if os.path.exists(file_to_delete):
-                os.remove(file_to_delete)
-                logger.info(f"Cleaned up dummy FITS file: {file_to_delete}")
-            else:
-                logger.debug(f"Dummy FITS file {file_to_delete} already removed or never existed.")
-        except OSError as e:
-            logger.warning(f"Error removing dummy FITS file {file_to_delete}: {e}")
 
-async def simulate_data_stream(interval_seconds: int = 5):
+def _remove_frame_file(file_path: str) -> None:
+    """
+    Deletes a frame's FITS file once no worker can still need it.
+    """
+    try:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+            logger.info(f"Cleaned up dummy FITS file: {file_path}")
+        else:
+            logger.debug(f"Dummy FITS file {file_path} already removed or never existed.")
+    except OSError as e:
+        logger.warning(f"Error removing dummy FITS file {file_path}: {e}")
+
+async def _call_backend(method, *args, **kwargs):
     """
-    Simulates a continuous stream of new FITS data and processes it.
+    Runs a blocking state backend call in the default executor, so waiting on
+    the SQLite write lock does not stall the event loop (and /latest_results).
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(method, *args, **kwargs))
+
+async def simulate_data_stream(interval_seconds: float = 5):
+    """
+    Simulates a continuous stream of new FITS data and enqueues each frame.
+    Every worker runs this loop, but only the holder of the producer lease
+    generates frames, so the stream is never duplicated.
     """
-    observation_count = 0
     while True:
-        observation_count += 1
-        dummy_file_name = f"dummy_asteroid_image_{observation_count:04d}.fits"
-        dummy_file_path = os.path.join(DUMMY_FITS_DIR, dummy_file_name)
-        
         try:
-            created_file = create_dummy_fits_file(dummy_file_path, observation_count)
-            await run_asteroid_detection_pipeline_async(created_file)
+            is_producer = await _call_backend(state_backend.acquire_producer_lease, WORKER_ID, lease_seconds=interval_seconds * 3)
+            if is_producer and await _call_backend(state_backend.pending_frame_count) < MAX_PENDING_FRAMES:
+                observation_id = await _call_backend(state_backend.next_observation_id)
+                dummy_file_name = f"dummy_asteroid_image_{observation_id:04d}.fits"
+                dummy_file_path = os.path.join(DUMMY_FITS_DIR, dummy_file_name)
+                created_file = create_dummy_fits_file(dummy_file_path, observation_id)
+                await _call_backend(state_backend.enqueue_frame, observation_id, created_file)
         except Exception as e:
             logger.error(f"Error in data stream simulation loop: {e}", exc_info=True)
         
         await asyncio.sleep(interval_seconds)
 
+async def process_frames(poll_seconds: float = FRAME_POLL_SECONDS):
+    """
+    Claims queued frames under a lease and runs the pipeline on each one.
+    Runs in every worker; the lease guarantees each frame is committed once.
+    A frame's file is only deleted once its results are committed or the
+    backend gives up on it, so a worker that reclaims an expired lease can
+    still read it.
+    """
+    while True:
+        frame = None
+        try:
+            for abandoned_file in await _call_backend(state_backend.reap_abandoned_frames):
+                _remove_frame_file(abandoned_file)
+            frame = await _call_backend(state_backend.claim_frame, WORKER_ID, lease_seconds=FRAME_LEASE_SECONDS)
+            if frame is None:
+                await asyncio.sleep(poll_seconds)
+                continue
+            results = await run_asteroid_detection_pipeline_async(frame['file_path'])
+            results['observation_id'] = frame['observation_id']
+            if await _call_backend(state_backend.complete_frame, frame['observation_id'], WORKER_ID, results):
+                _remove_frame_file(frame['file_path'])
+            else:
+                logger.warning(f"Lease on frame {frame['observation_id']} was lost; discarding results.")
+        except Exception as e:
+            logger.error(f"Error in frame processing loop: {e}", exc_info=True)
+            if frame is None:
+                await asyncio.sleep(poll_seconds)
+
 @app.on_event("startup")
 async def startup_event():
-    logger.info("Starting background data stream simulation...")
-    asyncio.create_task(simulate_data_stream(interval_seconds=5))
+    logger.info(f"Worker {WORKER_ID} starting with '{STATE_BACKEND}' state backend...")
+    asyncio.create_task(simulate_data_stream(interval_seconds=FRAME_INTERVAL_SECONDS))
+    asyncio.create_task(process_frames())
 
 @app.get("/latest_results")
 async def get_latest_results():
-    return latest_pipeline_results
+    return await _call_backend(state_backend.get_latest_results) or IDLE_PIPELINE_RESULTS
 
 @app.get("/")
 async def get_root():
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("torch")
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+import pipeline
+from utils.state_backend import InMemoryStateBackend
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    backend = InMemoryStateBackend()
+    monkeypatch.setattr(pipeline, "state_backend", backend)
+    return backend
+
+
+def _enqueue(backend, tmp_path):
+    observation_id = backend.next_observation_id()
+    file_path = tmp_path / f"frame_{observation_id}.fits"
+    file_path.write_bytes(b"")
+    backend.enqueue_frame(observation_id, str(file_path))
+    return observation_id, file_path
+
+
+async def _run_process_frames(done):
+    task = asyncio.create_task(pipeline.process_frames(poll_seconds=0.01))
+    try:
+        for _ in range(200):
+            if done():
+                return
+            await asyncio.sleep(0.01)
+        pytest.fail("process_frames did not finish in time")
+    finally:
+        task.cancel()
+
+
+def test_latest_results_idle_until_first_frame(backend):
+    assert asyncio.run(pipeline.get_latest_results()) == pipeline.IDLE_PIPELINE_RESULTS
+
+
+def test_process_frames_publishes_results_and_removes_file(backend, monkeypatch, tmp_path):
+    observation_id, file_path = _enqueue(backend, tmp_path)
+
+    async def fake_pipeline(fits_file_path):
+        assert os.path.exists(fits_file_path)
+        return {"status": "success", "filename": os.path.basename(fits_file_path)}
+
+    monkeypatch.setattr(pipeline, "run_asteroid_detection_pipeline_async", fake_pipeline)
+    asyncio.run(_run_process_frames(lambda: backend.get_latest_results() is not None))
+
+    results = asyncio.run(pipeline.get_latest_results())
+    assert results == {"status": "success", "filename": file_path.name, "observation_id": observation_id}
+    assert not file_path.exists()
+
+
+def test_lost_lease_keeps_file_for_reclaiming_worker(backend, monkeypatch, tmp_path):
+    observation_id, file_path = _enqueue(backend, tmp_path)
+    reclaimed = []
+    completions = []
+    complete_frame = backend.complete_frame
+
+    def recording_complete_frame(*args):
+        completions.append(complete_frame(*args))
+        return completions[-1]
+
+    async def slow_pipeline(fits_file_path):
+        # The lease expired while this worker was busy; another worker takes the frame over.
+        reclaimed.append(backend.claim_frame("other-worker", lease_seconds=60))
+        return {"status": "success"}
+
+    monkeypatch.setattr(backend, "complete_frame", recording_complete_frame)
+    monkeypatch.setattr(pipeline, "FRAME_LEASE_SECONDS", 0)
+    monkeypatch.setattr(pipeline, "run_asteroid_detection_pipeline_async", slow_pipeline)
+    asyncio.run(_run_process_frames(lambda: bool(completions)))
+
+    assert reclaimed[0]["observation_id"] == observation_id
+    assert completions == [False]
+    assert backend.get_latest_results() is None
+    assert file_path.exists()
+    assert backend.complete_frame(observation_id, "other-worker", {"status": "success"})
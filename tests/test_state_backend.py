@@ -0,0 +1,91 @@
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.state_backend import InMemoryStateBackend, SQLiteStateBackend, StateBackend, create_state_backend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return InMemoryStateBackend(max_attempts=2)
+    return SQLiteStateBackend(str(tmp_path / "state.db"), max_attempts=2)
+
+
+def test_frame_is_leased_once(backend):
+    backend.enqueue_frame(backend.next_observation_id(), "a.fits")
+    frame = backend.claim_frame("w1", lease_seconds=60)
+    assert frame == {'observation_id': 1, 'file_path': "a.fits", 'attempts': 1}
+    assert backend.claim_frame("w2", lease_seconds=60) is None
+    assert not backend.complete_frame(1, "w2", {"status": "success"})
+    assert backend.complete_frame(1, "w1", {"status": "success"})
+    assert backend.get_latest_results() == {"status": "success"}
+
+
+def test_expired_lease_is_reclaimed_then_abandoned(backend):
+    backend.enqueue_frame(backend.next_observation_id(), "a.fits")
+    assert backend.claim_frame("w1", lease_seconds=0)["attempts"] == 1
+    assert backend.reap_abandoned_frames() == []
+    assert backend.claim_frame("w2", lease_seconds=0)["attempts"] == 2
+    assert not backend.complete_frame(1, "w1", {"status": "success"})
+    assert backend.claim_frame("w3", lease_seconds=60) is None
+    assert backend.reap_abandoned_frames() == ["a.fits"]
+    assert backend.reap_abandoned_frames() == []
+    assert not backend.complete_frame(1, "w2", {"status": "success"})
+
+
+def test_older_frame_does_not_replace_latest_results(backend):
+    for _ in range(2):
+        backend.enqueue_frame(backend.next_observation_id(), "a.fits")
+    first = backend.claim_frame("w1", lease_seconds=60)
+    second = backend.claim_frame("w2", lease_seconds=60)
+    assert backend.complete_frame(second['observation_id'], "w2", {"frame": 2})
+    assert backend.complete_frame(first['observation_id'], "w1", {"frame": 1})
+    assert backend.get_latest_results() == {"frame": 2}
+
+
+def test_single_producer(backend):
+    assert backend.acquire_producer_lease("w1", lease_seconds=60)
+    assert not backend.acquire_producer_lease("w2", lease_seconds=60)
+    assert backend.acquire_producer_lease("w1", lease_seconds=0)
+    assert backend.acquire_producer_lease("w2", lease_seconds=60)
+
+
+def _drain(db_path, worker_id):
+    backend = SQLiteStateBackend(db_path)
+    claimed = []
+    while True:
+        frame = backend.claim_frame(worker_id, lease_seconds=60)
+        if frame is None:
+            return claimed
+        assert backend.complete_frame(frame['observation_id'], worker_id, {})
+        claimed.append(frame['observation_id'])
+
+
+def test_sqlite_frames_processed_once_across_processes(tmp_path):
+    db_path = str(tmp_path / "state.db")
+    backend = SQLiteStateBackend(db_path)
+    for _ in range(200):
+        backend.enqueue_frame(backend.next_observation_id(), "a.fits")
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        claimed = list(pool.map(_drain, [db_path] * 4, [f"w{i}" for i in range(4)]))
+    all_frames = [observation_id for worker in claimed for observation_id in worker]
+    assert sorted(all_frames) == list(range(1, 201))
+
+
+def test_partial_backend_cannot_be_created():
+    class PartialBackend(StateBackend):
+        def get_latest_results(self):
+            return None
+
+    with pytest.raises(TypeError):
+        PartialBackend()
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        create_state_backend("redis")
@@ -0,0 +1,392 @@
+# utils/state_backend.py
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+
+class StateBackend(ABC):
+    """
+    Shared state used by every pipeline worker process.
+
+    A backend holds three pieces of state:
+        - the producer lease, so only one worker generates simulated frames,
+        - the frame queue, handed out to workers under time-limited leases,
+        - the latest pipeline results, readable from any worker.
+
+    A frame is committed at most once: `complete_frame` only succeeds for the
+    worker that still holds the frame's lease. If a worker dies mid-frame its
+    lease expires and the frame is handed to another worker, up to
+    `max_attempts` times; after that it is dropped by `reap_abandoned_frames`.
+    """
+    @abstractmethod
+    def acquire_producer_lease(self, worker_id: str, lease_seconds: float) -> bool:
+        """
+        Acquires or renews the producer lease for `worker_id`.
+
+        Returns:
+            bool: True if `worker_id` holds the producer lease afterwards.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def next_observation_id(self) -> int:
+        """
+        Returns a new, globally unique observation id.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def enqueue_frame(self, observation_id: int, file_path: str) -> None:
+        """
+        Adds a frame to the queue, ready to be claimed by any worker.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def pending_frame_count(self) -> int:
+        """
+        Returns the number of frames that have not been claimed yet.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_frame(self, worker_id: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        """
+        Leases the oldest available frame to `worker_id`.
+
+        A frame is available if it is pending, or if its previous lease expired
+        and it has attempts left.
+
+        Returns:
+            Optional[Dict[str, Any]]: A dictionary with 'observation_id', 'file_path'
+                                      and 'attempts', or None if no frame is available.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def reap_abandoned_frames(self) -> List[str]:
+        """
+        Removes frames whose lease expired after `max_attempts` attempts.
+
+        Returns:
+            List[str]: The FITS file paths of the removed frames, for the caller to clean up.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def complete_frame(self, observation_id: int, worker_id: str, results: Dict[str, Any]) -> bool:
+        """
+        Marks a leased frame as done and publishes its results.
+
+        The latest results are only replaced if the frame is newer than the
+        one currently published, so out-of-order completions never go back in time.
+
+        Returns:
+            bool: False if `worker_id` no longer holds the lease (the results are discarded).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_latest_results(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the most recently published pipeline results, or None.
+        """
+        raise NotImplementedError
+
+
+class InMemoryStateBackend(StateBackend):
+    """
+    Process-local backend. Suitable for a single uvicorn worker only.
+    """
+    def __init__(self, max_attempts: int = 3):
+        self.logger = logging.getLogger("InMemoryStateBackend")
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._producer: Optional[str] = None
+        self._producer_expires = 0.0
+        self._last_observation_id = 0
+        self._frames: Dict[int, Dict[str, Any]] = {}
+        self._latest_results: Optional[Dict[str, Any]] = None
+        self._latest_observation_id = 0
+
+    def acquire_producer_lease(self, worker_id: str, lease_seconds: float) -> bool:
+        now = time.time()
+        with self._lock:
+            if self._producer in (None, worker_id) or self._producer_expires <= now:
+                self._producer = worker_id
+                self._producer_expires = now + lease_seconds
+                return True
+            return False
+
+    def next_observation_id(self) -> int:
+        with self._lock:
+            self._last_observation_id += 1
+            return self._last_observation_id
+
+    def enqueue_frame(self, observation_id: int, file_path: str) -> None:
+        with self._lock:
+            self._frames[observation_id] = {
+                'observation_id': observation_id,
+                'file_path': file_path,
+                'status': 'pending',
+                'lease_owner': None,
+                'lease_expires': 0.0,
+                'attempts': 0,
+            }
+
+    def pending_frame_count(self) -> int:
+        with self._lock:
+            return sum(1 for frame in self._frames.values() if frame['status'] == 'pending')
+
+    def claim_frame(self, worker_id: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        with self._lock:
+            for observation_id in sorted(self._frames):
+                frame = self._frames[observation_id]
+                if not (frame['status'] == 'pending' or self._is_retryable(frame, now)):
+                    continue
+                frame['status'] = 'leased'
+                frame['lease_owner'] = worker_id
+                frame['lease_expires'] = now + lease_seconds
+                frame['attempts'] += 1
+                return {k: frame[k] for k in ('observation_id', 'file_path', 'attempts')}
+            return None
+
+    def _is_retryable(self, frame: Dict[str, Any], now: float) -> bool:
+        return (frame['status'] == 'leased' and frame['lease_expires'] <= now
+                and frame['attempts'] < self.max_attempts)
+
+    def reap_abandoned_frames(self) -> List[str]:
+        now = time.time()
+        with self._lock:
+            abandoned = [
+                observation_id for observation_id, frame in self._frames.items()
+                if frame['status'] == 'leased' and frame['lease_expires'] <= now
+                and frame['attempts'] >= self.max_attempts
+            ]
+            file_paths = [self._frames.pop(observation_id)['file_path'] for observation_id in abandoned]
+        if abandoned:
+            self.logger.warning(f"Dropped frame(s) {abandoned} after {self.max_attempts} attempts.")
+        return file_paths
+
+    def complete_frame(self, observation_id: int, worker_id: str, results: Dict[str, Any]) -> bool:
+        with self._lock:
+            frame = self._frames.get(observation_id)
+            if frame is None or frame['status'] != 'leased' or frame['lease_owner'] != worker_id:
+                return False
+            # Finished frames are dropped so the queue does not grow without bound.
+            del self._frames[observation_id]
+            if observation_id >= self._latest_observation_id:
+                self._latest_observation_id = observation_id
+                self._latest_results = results
+            return True
+
+    def get_latest_results(self) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._latest_results
+
+
+class SQLiteStateBackend(StateBackend):
+    """
+    Backend stored in a SQLite database shared by all worker processes on a host.
+
+    Every mutation runs in a `BEGIN IMMEDIATE` transaction, which takes the
+    database write lock up front, so two workers can never lease the same frame.
+    The database runs in WAL mode so `/latest_results` reads do not block writers.
+    It stands in for a networked store (e.g. Redis or Postgres) with the same semantics.
+    """
+    def __init__(self, db_path: str, max_attempts: int = 3, busy_timeout: float = 30.0):
+        self.logger = logging.getLogger("SQLiteStateBackend")
+        self.db_path = db_path
+        self.max_attempts = max_attempts
+        self.busy_timeout = busy_timeout
+        self._init_schema()
+        self.logger.info(f"SQLiteStateBackend initialized at: {db_path}")
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call keeps the backend safe to share across threads and tasks.
+        # isolation_level=None lets us issue BEGIN IMMEDIATE ourselves.
+        return sqlite3.connect(self.db_path, timeout=self.busy_timeout, isolation_level=None)
+
+    def _init_schema(self) -> None:
+        directory = os.path.dirname(self.db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                " name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS counters ("
+                " name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS frames ("
+                " observation_id INTEGER PRIMARY KEY,"
+                " file_path TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " lease_owner TEXT,"
+                " lease_expires REAL NOT NULL DEFAULT 0,"
+                " attempts INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS frames_status ON frames (status, observation_id)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " name TEXT PRIMARY KEY, observation_id INTEGER NOT NULL, payload TEXT NOT NULL)"
+            )
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+
+    def acquire_producer_lease(self, worker_id: str, lease_seconds: float) -> bool:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT owner, expires FROM leases WHERE name = 'producer'").fetchone()
+            acquired = row is None or row[0] == worker_id or row[1] <= now
+            if acquired:
+                conn.execute(
+                    "INSERT OR REPLACE INTO leases (name, owner, expires) VALUES ('producer', ?, ?)",
+                    (worker_id, now + lease_seconds)
+                )
+            conn.execute("COMMIT")
+            return acquired
+        finally:
+            conn.close()
+
+    def next_observation_id(self) -> int:
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("INSERT OR IGNORE INTO counters (name, value) VALUES ('observation_id', 0)")
+            conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'observation_id'")
+            (value,) = conn.execute("SELECT value FROM counters WHERE name = 'observation_id'").fetchone()
+            conn.execute("COMMIT")
+            return value
+        finally:
+            conn.close()
+
+    def enqueue_frame(self, observation_id: int, file_path: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO frames (observation_id, file_path, status) VALUES (?, ?, 'pending')",
+                (observation_id, file_path)
+            )
+        finally:
+            conn.close()
+
+    def pending_frame_count(self) -> int:
+        conn = self._connect()
+        try:
+            (count,) = conn.execute("SELECT COUNT(*) FROM frames WHERE status = 'pending'").fetchone()
+            return count
+        finally:
+            conn.close()
+
+    def claim_frame(self, worker_id: str, lease_seconds: float) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT observation_id, file_path, attempts FROM frames"
+                " WHERE status = 'pending' OR (status = 'leased' AND lease_expires <= ? AND attempts < ?)"
+                " ORDER BY observation_id LIMIT 1",
+                (now, self.max_attempts)
+            ).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            observation_id, file_path, attempts = row
+            conn.execute(
+                "UPDATE frames SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = ?"
+                " WHERE observation_id = ?",
+                (worker_id, now + lease_seconds, attempts + 1, observation_id)
+            )
+            conn.execute("COMMIT")
+            return {'observation_id': observation_id, 'file_path': file_path, 'attempts': attempts + 1}
+        finally:
+            conn.close()
+
+    def reap_abandoned_frames(self) -> List[str]:
+        now = time.time()
+        query = (
+            "SELECT observation_id, file_path FROM frames"
+            " WHERE status = 'leased' AND lease_expires <= ? AND attempts >= ?"
+        )
+        conn = self._connect()
+        try:
+            # Check without the write lock first; this runs on every worker loop iteration.
+            if conn.execute(query, (now, self.max_attempts)).fetchone() is None:
+                return []
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(query, (now, self.max_attempts)).fetchall()
+            conn.executemany("DELETE FROM frames WHERE observation_id = ?", [(row[0],) for row in rows])
+            conn.execute("COMMIT")
+        finally:
+            conn.close()
+        if rows:
+            self.logger.warning(f"Dropped frame(s) {[row[0] for row in rows]} after {self.max_attempts} attempts.")
+        return [row[1] for row in rows]
+
+    def complete_frame(self, observation_id: int, worker_id: str, results: Dict[str, Any]) -> bool:
+        # default=str guards against stray non-JSON types (e.g. numpy scalars) in agent output.
+        payload = json.dumps(results, default=str)
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            # Finished frames are deleted so the queue does not grow without bound.
+            deleted = conn.execute(
+                "DELETE FROM frames WHERE observation_id = ? AND status = 'leased' AND lease_owner = ?",
+                (observation_id, worker_id)
+            ).rowcount
+            if not deleted:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT INTO results (name, observation_id, payload) VALUES ('latest', ?, ?)"
+                " ON CONFLICT(name) DO UPDATE SET observation_id = excluded.observation_id, payload = excluded.payload"
+                " WHERE excluded.observation_id >= results.observation_id",
+                (observation_id, payload)
+            )
+            conn.execute("COMMIT")
+            return True
+        finally:
+            conn.close()
+
+    def get_latest_results(self) -> Optional[Dict[str, Any]]:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT payload FROM results WHERE name = 'latest'").fetchone()
+            return json.loads(row[0]) if row else None
+        finally:
+            conn.close()
+
+
+def create_state_backend(kind: str, db_path: str = "pipeline_state.db") -> StateBackend:
+    """
+    Creates a state backend by name.
+
+    Args:
+        kind (str): 'memory' for a single worker, or 'sqlite' to share state
+                    between several worker processes on the same host.
+        db_path (str): Path to the SQLite database (only used by 'sqlite').
+
+    Raises:
+        ValueError: If `kind` is not a known backend.
+    """
+    if kind == "memory":
+        return InMemoryStateBackend()
+    if kind == "sqlite":
+        return SQLiteStateBackend(db_path)
+    raise ValueError(f"Unknown state backend: {kind!r}. Expected 'memory' or 'sqlite'.")